@@ -3,19 +3,25 @@ FastAPI сервер для комплексного агента
 Предоставляет HTTP API и веб-интерфейс для работы с агентом
 """
 import asyncio
+import fcntl
 import logging
+import random
 import time
 import traceback
 import uuid
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 from typing import Optional
 from pathlib import Path
-from fastapi import FastAPI, HTTPException, Request
+import orjson
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from composite_agent import CompositeAnalysisAgent
+from config import MAX_CONCURRENT_ANALYSES, TEMP_DIR, WEB_CONCURRENCY
 
 # Настройка логирования
 logging.basicConfig(
@@ -25,11 +31,117 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Таймаут агента (секунды)
+AGENT_TIMEOUT = 240
+
+# Периодическая очистка (секунды): интервал, случайный сдвиг, потолок backoff
+CLEANUP_INTERVAL = 1800
+CLEANUP_JITTER = 300
+CLEANUP_MAX_INTERVAL = 4 * 3600
+
+# Файл блокировки периодической очистки (общий для всех воркеров)
+CLEANUP_LOCK_PATH = TEMP_DIR / ".cleanup.lock"
+# Отметка последней общей очистки (mtime файла), читается под блокировкой
+CLEANUP_STAMP_PATH = TEMP_DIR / ".last_cleanup"
+
+# Глобальный экземпляр агента
+agent = None
+
+# Ограничение одновременных анализов в воркере (pandas/matplotlib съедают RAM)
+_analysis_semaphore = asyncio.Semaphore(MAX_CONCURRENT_ANALYSES)
+
+
+def _release_analysis_slot(future: asyncio.Future):
+    """Вернуть слот семафора по завершении потока с agent.analyze"""
+    _analysis_semaphore.release()
+    # Результат после таймаута уже никто не ждёт — пометить ошибку прочитанной
+    if not future.cancelled():
+        future.exception()
+
+
+def _last_cleanup_time() -> float:
+    """Время последней общей очистки (0, если её ещё не было)"""
+    try:
+        return CLEANUP_STAMP_PATH.stat().st_mtime
+    except FileNotFoundError:
+        return 0.0
+
+
+async def cleanup_loop():
+    """Фоновая задача для очистки"""
+    failures = 0
+    while True:
+        # Каждые 30 минут + случайный сдвиг, чтобы воркеры не просыпались разом;
+        # после ошибок интервал растёт экспоненциально
+        delay = min(CLEANUP_INTERVAL * 2 ** failures, CLEANUP_MAX_INTERVAL)
+        await asyncio.sleep(delay + random.uniform(0, CLEANUP_JITTER))
+        try:
+            # Общую очистку (SQLite, обход TEMP_DIR) за интервал выполняет один
+            # воркер: блокировка не даёт двум проходам идти одновременно, а
+            # отметка времени под ней — повторить проход, уже сделанный
+            # другим воркером (воркеры просыпаются вразброс и за блокировку
+            # почти не конкурируют)
+            with open(CLEANUP_LOCK_PATH, "w") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    done_recently = time.time() - _last_cleanup_time() < CLEANUP_INTERVAL
+                except BlockingIOError:
+                    done_recently = True
+
+                if done_recently:
+                    # Свои parquet файлы (из реестра) каждый воркер удаляет сам
+                    await asyncio.to_thread(agent.cleanup_temp_files, False)
+                else:
+                    # Дисковый I/O (DELETE в SQLite, обход TEMP_DIR) — вне event loop
+                    await asyncio.to_thread(agent.chat_storage.cleanup_expired)
+                    await asyncio.to_thread(agent.cleanup_temp_files)
+                    CLEANUP_STAMP_PATH.touch()
+            failures = 0
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            failures += 1
+            logger.error("❌ Ошибка очистки (попытка %d): %s", failures, e)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Инициализация при запуске и освобождение ресурсов при остановке"""
+    global agent
+    try:
+        agent = CompositeAnalysisAgent()
+        logger.info("✅ Агент инициализирован")
+    except Exception as e:
+        logger.error("❌ Ошибка инициализации агента: %s", e)
+        raise
+
+    # Пул потоков по реальной нагрузке: семафор держит слот до конца потока
+    # (и после таймаута), поэтому agent.analyze одновременно идёт не более чем
+    # в MAX_CONCURRENT_ANALYSES потоках; +2 — для to_thread из cleanup_loop
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=MAX_CONCURRENT_ANALYSES + 2, thread_name_prefix="agent")
+    )
+
+    # Ссылка на задачу держится здесь до остановки (asyncio хранит только слабые)
+    cleanup_task = asyncio.create_task(cleanup_loop())
+    try:
+        yield
+    finally:
+        # Остановить очистку до закрытия соединений SQLite
+        cleanup_task.cancel()
+        try:
+            await cleanup_task
+        except asyncio.CancelledError:
+            pass
+        agent.chat_storage.close()
+
+
 # Инициализация FastAPI
 app = FastAPI(
     title="ClickHouse Analysis Agent API",
     description="Комплексный ИИ-агент для анализа данных из ClickHouse",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
 )
 
 # CORS настройки
@@ -41,9 +153,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Таймаут агента (секунды)
-AGENT_TIMEOUT = 240
-
 
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
@@ -60,9 +169,6 @@ async def log_requests(request: Request, call_next):
     )
     return response
 
-# Глобальный экземпляр агента
-agent = None
-
 
 class AnalyzeRequest(BaseModel):
     """Запрос на анализ"""
@@ -81,68 +187,68 @@ class AnalyzeResponse(BaseModel):
     timestamp: str
 
 
-@app.on_event("startup")
-async def startup():
-    """Инициализация при запуске"""
-    global agent
-    try:
-        agent = CompositeAnalysisAgent()
-        logger.info("✅ Агент инициализирован")
-    except Exception as e:
-        logger.error("❌ Ошибка инициализации агента: %s", e)
-        raise
+def _json_response(content: dict, status_code: int = 200, headers: Optional[dict] = None) -> Response:
+    """JSON-ответ через orjson — быстрая сериализация base64-графиков"""
+    return Response(
+        content=orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY),
+        status_code=status_code,
+        headers=headers,
+        media_type="application/json",
+    )
 
-    # Фоновая задача для очистки
-    async def cleanup_loop():
-        while True:
-            await asyncio.sleep(1800)  # каждые 30 минут
-            try:
-                agent.chat_storage.cleanup_expired()
-                agent.cleanup_temp_files()
-            except Exception as e:
-                logger.error("❌ Ошибка очистки: %s", e)
 
-    asyncio.create_task(cleanup_loop())
+# Статические ответы служебных endpoint'ов — сериализуются один раз
+STATUS_BODY = orjson.dumps({
+    "status": "online",
+    "model": "Claude Sonnet 4",
+    "service": "ClickHouse Analysis Agent"
+})
+
+INFO_BODY = orjson.dumps({
+    "version": "1.0.0",
+    "model": "Claude Sonnet 4",
+    "features": [
+        "ClickHouse data extraction",
+        "Python analysis with pandas/numpy",
+        "Matplotlib/Seaborn visualizations",
+        "Chat history with SQLite",
+        "Parquet data format support"
+    ],
+    "tools": [
+        "list_tables",
+        "clickhouse_query",
+        "python_analysis"
+    ]
+})
+
+
+@lru_cache(maxsize=1)
+def _health_body(second: int) -> bytes:
+    """Тело ответа /health, пересобирается не чаще раза в секунду"""
+    return orjson.dumps({
+        "status": "healthy",
+        "timestamp": datetime.fromtimestamp(second).isoformat()
+    })
 
 
+# Служебные endpoint'ы без I/O — async def, без прыжка в threadpool;
+# синхронный (def) только /api/chat-stats, он читает SQLite
 @app.get("/health")
 async def health():
     """Health check endpoint"""
-    return {
-        "status": "healthy",
-        "timestamp": datetime.now().isoformat()
-    }
+    return Response(content=_health_body(int(time.time())), media_type="application/json")
 
 
 @app.get("/api/status")
 async def status():
     """API status"""
-    return {
-        "status": "online",
-        "model": "Claude Sonnet 4",
-        "service": "ClickHouse Analysis Agent"
-    }
+    return Response(content=STATUS_BODY, media_type="application/json")
 
 
 @app.get("/api/info")
 async def info():
     """Информация о сервисе"""
-    return {
-        "version": "1.0.0",
-        "model": "Claude Sonnet 4",
-        "features": [
-            "ClickHouse data extraction",
-            "Python analysis with pandas/numpy",
-            "Matplotlib/Seaborn visualizations",
-            "Chat history with SQLite",
-            "Parquet data format support"
-        ],
-        "tools": [
-            "list_tables",
-            "clickhouse_query",
-            "python_analysis"
-        ]
-    }
+    return Response(content=INFO_BODY, media_type="application/json")
 
 
 @app.post("/api/analyze", response_model=AnalyzeResponse)
@@ -166,17 +272,45 @@ async def analyze(request: AnalyzeRequest):
         raise HTTPException(status_code=503, detail="Агент не инициализирован")
 
     # Генерация session_id если не передан
-    session_id = request.session_id or str(uuid.uuid4())
+    session_id = request.session_id or uuid.uuid4().hex
+
+    # Все слоты заняты — сразу отказываем, а не копим очередь в памяти
+    if _analysis_semaphore.locked():
+        logger.warning("⏳ Перегрузка: session_id=%s (лимит %d анализов)", session_id, MAX_CONCURRENT_ANALYSES)
+        return _json_response(
+            status_code=503,
+            headers={"Retry-After": "10"},
+            content={
+                "success": False,
+                "session_id": session_id,
+                "text_output": "",
+                "plots": [],
+                "tool_calls": [],
+                "error": "Сервер занят другими запросами. Повторите попытку через несколько секунд.",
+                "timestamp": datetime.now().isoformat(),
+            },
+        )
 
     logger.info("📥 Запрос: session_id=%s query=%.80r", session_id, request.query)
     start = time.time()
 
-    # Выполнение анализа в отдельном потоке (синхронный anthropic client)
+    # Выполнение анализа в отдельном потоке (синхронный anthropic client).
+    # Endpoint остаётся async ради таймаута и семафора; run_in_executor
+    # напрямую — без copy_context(), который делает asyncio.to_thread
+    loop = asyncio.get_running_loop()
     try:
-        result = await asyncio.wait_for(
-            asyncio.to_thread(agent.analyze, request.query, session_id),
-            timeout=AGENT_TIMEOUT,
-        )
+        # Слот освобождается, когда поток действительно закончит анализ, а не
+        # при выходе по таймауту: после таймаута поток продолжает работать,
+        # и лимит должен учитывать и такие (самые тяжёлые) анализы
+        await _analysis_semaphore.acquire()
+        try:
+            future = loop.run_in_executor(None, agent.analyze, request.query, session_id)
+        except BaseException:
+            _analysis_semaphore.release()
+            raise
+        future.add_done_callback(_release_analysis_slot)
+        # shield — таймаут отменяет только ожидание, а не future потока
+        result = await asyncio.wait_for(asyncio.shield(future), timeout=AGENT_TIMEOUT)
         elapsed = round(time.time() - start, 1)
         logger.info(
             "✅ Ответ: session_id=%s success=%s tool_calls=%d plots=%d time=%.1fs",
@@ -187,7 +321,10 @@ async def analyze(request: AnalyzeRequest):
             elapsed,
         )
         result["timestamp"] = datetime.now().isoformat()
-        return result
+        # Response отдаётся напрямую: FastAPI не перепроверяет результат по
+        # AnalyzeResponse (он остаётся для схемы OpenAPI) и не гоняет base64
+        # графики через jsonable_encoder
+        return _json_response(result)
     except asyncio.TimeoutError:
         elapsed = round(time.time() - start, 1)
         logger.error(
@@ -196,7 +333,7 @@ async def analyze(request: AnalyzeRequest):
             elapsed,
             AGENT_TIMEOUT,
         )
-        return JSONResponse(
+        return _json_response(
             status_code=504,
             content={
                 "success": False,
@@ -221,7 +358,7 @@ async def analyze(request: AnalyzeRequest):
 
 
 @app.get("/api/chat-stats")
-async def chat_stats():
+def chat_stats():
     """Статистика по чатам"""
     if not agent:
         raise HTTPException(status_code=503, detail="Агент не инициализирован")
@@ -246,6 +383,10 @@ if __name__ == "__main__":
         "api_server:app",
         host="0.0.0.0",
         port=8000,
+        workers=WEB_CONCURRENCY,
+        loop="uvloop",
+        http="httptools",
         reload=False,
-        access_log=True
+        # Запросы уже логирует middleware log_requests
+        access_log=False,
     )
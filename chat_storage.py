@@ -1,10 +1,44 @@
 """
 SQLite хранилище для истории чатов
 """
+import queue
 import sqlite3
 import json
-from datetime import datetime, timedelta
-from pathlib import Path
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import time
+
+# Версия схемы БД (PRAGMA user_version)
+SCHEMA_VERSION = 2
+
+# busy_timeout на время инициализации/миграции схемы (мс)
+INIT_BUSY_TIMEOUT_MS = 60000
+
+# Лимит ответа ассистента в байтах UTF-8 (~3000 символов кириллицы)
+ASSISTANT_MAX_BYTES = 6000
+TRUNCATE_TAIL = "\n\n[...обрезано...]"
+
+# Сколько сессий держать в кэше истории
+HISTORY_CACHE_SIZE = 256
+
+# Время хранится как INTEGER unix epoch (секунды, UTC)
+EPOCH_NOW = "(CAST(strftime('%s', 'now') AS INTEGER))"
+
+SESSIONS_COLUMNS = f"""(
+    session_id TEXT PRIMARY KEY,
+    created_at INTEGER DEFAULT {EPOCH_NOW},
+    last_activity INTEGER DEFAULT {EPOCH_NOW}
+)"""
+
+MESSAGES_COLUMNS = f"""(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    role TEXT NOT NULL CHECK(role IN ('user', 'assistant')),
+    content TEXT NOT NULL,
+    created_at INTEGER DEFAULT {EPOCH_NOW},
+    FOREIGN KEY (session_id) REFERENCES sessions(session_id) ON DELETE CASCADE
+)"""
 
 
 class ChatStorage:
@@ -14,187 +48,424 @@ class ChatStorage:
         self,
         db_path: str = "./chat_history.db",
         max_messages_per_session: int = 20,
-        session_ttl_hours: int = 24
+        session_ttl_hours: int = 24,
+        read_pool_size: int = 4
     ):
         self.db_path = db_path
         self.max_messages = max_messages_per_session
         self.session_ttl_hours = session_ttl_hours
+
+        # Одно соединение на запись (SQLite всё равно сериализует запись)
+        self._write_lock = threading.Lock()
+        self._write_conn = self._connect()
         self._init_db()
 
+        # LRU-кэш истории: session_id -> (id последнего сообщения, список сообщений)
+        self._history_lock = threading.Lock()
+        self._history_cache = OrderedDict()
+
+        # Пул соединений только для чтения (WAL допускает параллельное чтение)
+        self._read_pool = queue.Queue()
+        for _ in range(read_pool_size):
+            self._read_pool.put(self._connect(read_only=True))
+
+    def _connect(self, read_only: bool = False) -> sqlite3.Connection:
+        """Открыть соединение, разделяемое между потоками"""
+        if read_only:
+            conn = sqlite3.connect(
+                f"file:{self.db_path}?mode=ro", uri=True,
+                check_same_thread=False, cached_statements=256,
+            )
+        else:
+            conn = sqlite3.connect(
+                self.db_path, check_same_thread=False, cached_statements=256
+            )
+
+        # В WAL режиме NORMAL не теряет целостность при сбое и не делает fsync на каждый commit
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute("PRAGMA temp_store=MEMORY;")
+        conn.execute("PRAGMA cache_size=-20000;")  # ~20 МБ
+        conn.execute("PRAGMA mmap_size=268435456;")  # 256 МБ
+        # Ждать блокировку вместо немедленного "database is locked" (несколько воркеров)
+        conn.execute("PRAGMA busy_timeout=5000;")
+        # Нужно для ON DELETE CASCADE сообщений при удалении сессии
+        conn.execute("PRAGMA foreign_keys=ON;")
+        return conn
+
+    @contextmanager
+    def _writer(self):
+        """
+        Эксклюзивный доступ к соединению на запись.
+        При ошибке незавершённая транзакция откатывается: иначе соединение
+        держало бы блокировку записи SQLite, а следующий commit() другого
+        вызова сохранил бы частично записанные строки.
+        """
+        with self._write_lock:
+            try:
+                yield self._write_conn
+            except BaseException:
+                self._write_conn.rollback()
+                raise
+
+    @contextmanager
+    def _reader(self):
+        """Взять соединение для чтения из пула и вернуть после использования"""
+        conn = self._read_pool.get()
+        try:
+            yield conn
+        finally:
+            self._read_pool.put(conn)
+
+    def close(self):
+        """Закрыть все соединения"""
+        with self._write_lock:
+            self._write_conn.close()
+        while not self._read_pool.empty():
+            self._read_pool.get_nowait().close()
+
     def _init_db(self):
         """Инициализация базы данных"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._write_conn
         cursor = conn.cursor()
 
         # Включить WAL mode для лучшей производительности
         cursor.execute("PRAGMA journal_mode=WAL;")
+        # Ограничить рост WAL-файла при длительной нагрузке
+        cursor.execute("PRAGMA wal_autocheckpoint=1000;")
+
+        # Миграции существующей БД.
+        # Внешние ключи выключены на время пересоздания таблиц,
+        # иначе DROP TABLE sessions каскадно удалил бы все сообщения
+        # (PRAGMA foreign_keys вне транзакции не действует — ставим до BEGIN)
+        cursor.execute("PRAGMA foreign_keys=OFF;")
+        # Пока другой воркер мигрирует большую БД, ждать дольше обычного
+        cursor.execute(f"PRAGMA busy_timeout={INIT_BUSY_TIMEOUT_MS};")
+        try:
+            # Вся инициализация — одна транзакция: DDL в sqlite3 иначе
+            # выполняется в autocommit, и сбой посреди миграции оставил бы
+            # БД наполовину пересозданной. IMMEDIATE сразу берёт блокировку
+            # записи, поэтому параллельно стартующие воркеры выполняют
+            # инициализацию по очереди, и user_version читается уже под ней
+            cursor.execute("BEGIN IMMEDIATE")
+            self._init_schema(cursor)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            cursor.execute("PRAGMA busy_timeout=5000;")
+            cursor.execute("PRAGMA foreign_keys=ON;")
+
+    def _init_schema(self, cursor: sqlite3.Cursor):
+        """Миграции и создание схемы (внутри транзакции _init_db, без commit)"""
+        cursor.execute("PRAGMA user_version;")
+        version = cursor.fetchone()[0]
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages'")
+        if cursor.fetchone():
+            if version < 1:
+                self._migrate_messages_cascade(cursor)
+            if version < 2:
+                self._migrate_epoch_timestamps(cursor)
 
         # Таблица сессий
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS sessions {SESSIONS_COLUMNS}")
+
+        # Таблица сообщений
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS messages {MESSAGES_COLUMNS}")
+
+        # Индекс для поиска устаревших сессий
         cursor.execute("""
-            CREATE TABLE IF NOT EXISTS sessions (
-                session_id TEXT PRIMARY KEY,
-                created_at TEXT DEFAULT (datetime('now')),
-                last_activity TEXT DEFAULT (datetime('now'))
-            )
+            CREATE INDEX IF NOT EXISTS idx_sessions_activity
+            ON sessions(last_activity)
         """)
 
-        # Таблица сообщений
+        # Индекс для скользящего окна по id
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_msg_session_id
+            ON messages(session_id, id)
+        """)
+
+        # Счётчики строк для get_stats (поддерживаются триггерами)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS stats (
+                k TEXT PRIMARY KEY,
+                v INTEGER NOT NULL
+            )
+        """)
+        for table in ("sessions", "messages"):
+            cursor.execute(f"""
+                INSERT OR IGNORE INTO stats (k, v) SELECT '{table}', COUNT(*) FROM {table}
+            """)
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_insert AFTER INSERT ON {table}
+                BEGIN UPDATE stats SET v = v + 1 WHERE k = '{table}'; END
+            """)
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_delete AFTER DELETE ON {table}
+                BEGIN UPDATE stats SET v = v - 1 WHERE k = '{table}'; END
+            """)
+
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION};")
+
+    def _migrate_messages_cascade(self, cursor: sqlite3.Cursor):
+        """
+        v0 → v1: пересоздать messages с ON DELETE CASCADE
+        (SQLite не умеет менять внешний ключ через ALTER TABLE).
+        Индексы, триггеры и счётчики создаются заново в _init_db.
+        """
+        cursor.execute("DROP TRIGGER IF EXISTS trg_messages_insert")
+        cursor.execute("DROP TRIGGER IF EXISTS trg_messages_delete")
+        cursor.execute("DROP INDEX IF EXISTS idx_msg_session")
+        cursor.execute("DROP INDEX IF EXISTS idx_msg_session_id")
+        cursor.execute("DROP TABLE IF EXISTS stats")
+        cursor.execute("ALTER TABLE messages RENAME TO messages_v0")
         cursor.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
+            CREATE TABLE messages (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 session_id TEXT NOT NULL,
                 role TEXT NOT NULL CHECK(role IN ('user', 'assistant')),
                 content TEXT NOT NULL,
                 created_at TEXT DEFAULT (datetime('now')),
-                FOREIGN KEY (session_id) REFERENCES sessions(session_id)
+                FOREIGN KEY (session_id) REFERENCES sessions(session_id) ON DELETE CASCADE
             )
         """)
-
-        # Индекс для быстрого поиска
+        # Сообщения без сессии (осиротевшие) не переносим
         cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_msg_session
-            ON messages(session_id, created_at)
+            INSERT INTO messages (id, session_id, role, content, created_at)
+            SELECT id, session_id, role, content, created_at FROM messages_v0
+            WHERE session_id IN (SELECT session_id FROM sessions)
         """)
+        cursor.execute("DROP TABLE messages_v0")
 
-        conn.commit()
-        conn.close()
+    def _migrate_epoch_timestamps(self, cursor: sqlite3.Cursor):
+        """
+        v1 → v2: created_at/last_activity из TEXT datetime('now') в INTEGER epoch.
+        Таблицы пересоздаются (новая → копия → DROP старой → RENAME).
+        Индексы, триггеры и счётчики создаются заново в _init_db.
+        """
+        for table in ("sessions", "messages"):
+            cursor.execute(f"DROP TRIGGER IF EXISTS trg_{table}_insert")
+            cursor.execute(f"DROP TRIGGER IF EXISTS trg_{table}_delete")
+        for index in ("idx_msg_session", "idx_msg_session_id", "idx_sessions_activity"):
+            cursor.execute(f"DROP INDEX IF EXISTS {index}")
+        cursor.execute("DROP TABLE IF EXISTS stats")
+
+        cursor.execute(f"CREATE TABLE sessions_new {SESSIONS_COLUMNS}")
+        cursor.execute("""
+            INSERT INTO sessions_new (session_id, created_at, last_activity)
+            SELECT session_id,
+                   CAST(strftime('%s', created_at) AS INTEGER),
+                   CAST(strftime('%s', last_activity) AS INTEGER)
+            FROM sessions
+        """)
+        cursor.execute(f"CREATE TABLE messages_new {MESSAGES_COLUMNS}")
+        cursor.execute("""
+            INSERT INTO messages_new (id, session_id, role, content, created_at)
+            SELECT id, session_id, role, content,
+                   CAST(strftime('%s', created_at) AS INTEGER)
+            FROM messages
+        """)
+        cursor.execute("DROP TABLE messages")
+        cursor.execute("DROP TABLE sessions")
+        cursor.execute("ALTER TABLE sessions_new RENAME TO sessions")
+        cursor.execute("ALTER TABLE messages_new RENAME TO messages")
 
     def save_user_message(self, session_id: str, text: str):
         """Сохранить сообщение пользователя"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self._writer() as conn:
+            cursor = conn.cursor()
 
-        # Создать сессию если не существует
-        cursor.execute("""
-            INSERT OR IGNORE INTO sessions (session_id) VALUES (?)
-        """, (session_id,))
+            # Создать сессию если не существует
+            cursor.execute("""
+                INSERT OR IGNORE INTO sessions (session_id) VALUES (?)
+            """, (session_id,))
 
-        # Обновить время последней активности
-        cursor.execute("""
-            UPDATE sessions SET last_activity = datetime('now') WHERE session_id = ?
-        """, (session_id,))
+            # Обновить время последней активности
+            cursor.execute("""
+                UPDATE sessions SET last_activity = ? WHERE session_id = ?
+            """, (int(time.time()), session_id))
 
-        # Сохранить сообщение
-        cursor.execute("""
-            INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)
-        """, (session_id, "user", text))
+            # Последнее сообщение до вставки — для сверки с кэшем истории
+            prev_id = self._last_message_id(cursor, session_id)
+
+            # Сохранить сообщение
+            cursor.execute("""
+                INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)
+            """, (session_id, "user", text))
+            message_id = cursor.lastrowid
 
-        conn.commit()
-        conn.close()
+            # Применить скользящее окно (в той же транзакции)
+            self._apply_sliding_window(cursor, session_id)
 
-        # Применить скользящее окно
-        self._apply_sliding_window(session_id)
+            conn.commit()
+            self._cache_message(session_id, prev_id, message_id, "user", text)
 
     def save_assistant_message(self, session_id: str, text: str):
         """Сохранить ответ ассистента (ТОЛЬКО текст, без base64 графиков)"""
-        # Обрезать если слишком длинный
-        if len(text) > 3000:
-            text = text[:3000] + "\n\n[...обрезано...]"
+        # Обрезать если слишком длинный. Символ UTF-8 занимает не больше
+        # 4 байт, поэтому короткий текст не кодируется вовсе
+        if len(text) > ASSISTANT_MAX_BYTES // 4:
+            raw = text.encode("utf-8")
+            if len(raw) > ASSISTANT_MAX_BYTES:
+                text = raw[:ASSISTANT_MAX_BYTES].decode("utf-8", "ignore") + TRUNCATE_TAIL
 
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self._writer() as conn:
+            cursor = conn.cursor()
 
-        # Обновить время последней активности
-        cursor.execute("""
-            UPDATE sessions SET last_activity = datetime('now') WHERE session_id = ?
-        """, (session_id,))
+            # Сессию могла удалить очистка, пока шёл анализ
+            cursor.execute("""
+                INSERT OR IGNORE INTO sessions (session_id) VALUES (?)
+            """, (session_id,))
 
-        # Сохранить сообщение
-        cursor.execute("""
-            INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)
-        """, (session_id, "assistant", text))
+            # Обновить время последней активности
+            cursor.execute("""
+                UPDATE sessions SET last_activity = ? WHERE session_id = ?
+            """, (int(time.time()), session_id))
+
+            # Последнее сообщение до вставки — для сверки с кэшем истории
+            prev_id = self._last_message_id(cursor, session_id)
 
-        conn.commit()
-        conn.close()
+            # Сохранить сообщение
+            cursor.execute("""
+                INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)
+            """, (session_id, "assistant", text))
+            message_id = cursor.lastrowid
 
-        # Применить скользящее окно
-        self._apply_sliding_window(session_id)
+            # Применить скользящее окно (в той же транзакции)
+            self._apply_sliding_window(cursor, session_id)
+
+            conn.commit()
+            self._cache_message(session_id, prev_id, message_id, "assistant", text)
 
     def get_history(self, session_id: str) -> list:
         """
         Получить историю диалога для сессии.
         Возвращает список словарей с ключами 'role' и 'content'.
+        Список общий с кэшем: сам список — копия, словари менять нельзя.
         """
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
+        with self._reader() as conn:
+            # Кэш актуален, если последнее сообщение в БД то же самое
+            # (его мог изменить другой воркер или удалить очистка)
+            last_id = self._last_message_id(conn, session_id)
+            with self._history_lock:
+                cached = self._history_cache.get(session_id)
+                if cached is not None and cached[0] == last_id:
+                    self._history_cache.move_to_end(session_id)
+                    return list(cached[1])
+
+            # Итерация по курсору без промежуточного списка fetchall();
+            # id последней строки — ключ актуальности кэша
+            history = []
+            last_id = None
+            for last_id, role, content in conn.execute("""
+                SELECT id, role, content FROM messages
+                WHERE session_id = ?
+                ORDER BY id ASC
+            """, (session_id,)):
+                history.append({"role": role, "content": content})
+
+        with self._history_lock:
+            self._store_history(session_id, last_id, history)
+        return list(history)
+
+    @staticmethod
+    def _last_message_id(conn, session_id: str):
+        """id последнего сообщения сессии (по индексу) или None"""
+        return conn.execute(
+            "SELECT MAX(id) FROM messages WHERE session_id = ?", (session_id,)
+        ).fetchone()[0]
+
+    def _store_history(self, session_id: str, last_id, history: list):
+        """Положить историю в LRU-кэш (вызывать под _history_lock)"""
+        self._history_cache[session_id] = (last_id, history)
+        self._history_cache.move_to_end(session_id)
+        if len(self._history_cache) > HISTORY_CACHE_SIZE:
+            self._history_cache.popitem(last=False)
+
+    def _cache_message(self, session_id: str, prev_id, message_id: int, role: str, content: str):
+        """
+        Дописать сохранённое сообщение в кэш истории.
+        Если кэш отстал от БД (prev_id не совпал) — сбросить запись.
+        """
+        with self._history_lock:
+            cached = self._history_cache.get(session_id)
+            if cached is None and prev_id is not None:
+                return
+            if cached is not None and cached[0] != prev_id:
+                del self._history_cache[session_id]
+                return
+            history = cached[1] if cached is not None else []
+            history.append({"role": role, "content": content})
+            # То же скользящее окно, что и в БД
+            del history[:-self.max_messages]
+            self._store_history(session_id, message_id, history)
+
+    def _apply_sliding_window(self, cursor: sqlite3.Cursor, session_id: str):
+        """
+        Удалить лишние сообщения, оставив только последние N.
+        Выполняется внутри транзакции вызывающего метода (без commit).
+        """
+        # id растёт монотонно: находим (N+1)-е с конца сообщение по индексу
         cursor.execute("""
-            SELECT role, content FROM messages
+            SELECT id FROM messages
             WHERE session_id = ?
-            ORDER BY created_at ASC
-        """, (session_id,))
+            ORDER BY id DESC
+            LIMIT 1 OFFSET ?
+        """, (session_id, self.max_messages))
+        pivot = cursor.fetchone()
 
-        history = []
-        for row in cursor.fetchall():
-            history.append({"role": row[0], "content": row[1]})
-
-        conn.close()
-        return history
-
-    def _apply_sliding_window(self, session_id: str):
-        """Удалить лишние сообщения, оставив только последние N"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        # Сессия ещё не превысила лимит — удалять нечего
+        if pivot is None:
+            return
 
         cursor.execute("""
-            DELETE FROM messages
-            WHERE session_id = ? AND id NOT IN (
-                SELECT id FROM messages
-                WHERE session_id = ?
-                ORDER BY created_at DESC
-                LIMIT ?
-            )
-        """, (session_id, session_id, self.max_messages))
-
-        conn.commit()
-        conn.close()
+            DELETE FROM messages WHERE session_id = ? AND id <= ?
+        """, (session_id, pivot[0]))
 
     def cleanup_expired(self):
         """Удалить сессии старше TTL"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        cutoff_time = int(time.time()) - self.session_ttl_hours * 3600
 
-        cutoff_time = (datetime.now() - timedelta(hours=self.session_ttl_hours)).isoformat()
+        # Дешёвая проверка по индексу: нет устаревших сессий — не берём блокировку на запись
+        with self._reader() as conn:
+            expired = conn.execute("""
+                SELECT 1 FROM sessions WHERE last_activity < ? LIMIT 1
+            """, (cutoff_time,)).fetchone()
+        if expired is None:
+            return
 
-        # Удалить старые сообщения
-        cursor.execute("""
-            DELETE FROM messages WHERE session_id IN (
-                SELECT session_id FROM sessions WHERE last_activity < ?
-            )
-        """, (cutoff_time,))
+        with self._writer() as conn:
+            cursor = conn.cursor()
 
-        # Удалить старые сессии
-        cursor.execute("""
-            DELETE FROM sessions WHERE last_activity < ?
-        """, (cutoff_time,))
+            # Удалить старые сессии (сообщения удаляются каскадно)
+            cursor.execute("""
+                DELETE FROM sessions WHERE last_activity < ?
+            """, (cutoff_time,))
 
-        deleted_sessions = cursor.rowcount
-        conn.commit()
-        conn.close()
+            deleted_sessions = cursor.rowcount
+            conn.commit()
 
         if deleted_sessions > 0:
             print(f"🗑️  Удалено {deleted_sessions} устаревших сессий")
 
     def get_stats(self) -> dict:
         """Получить статистику по чатам"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        # Количество активных сессий
-        cursor.execute("SELECT COUNT(*) FROM sessions")
-        active_sessions = cursor.fetchone()[0]
+        with self._reader() as conn:
+            cursor = conn.cursor()
 
-        # Общее количество сообщений
-        cursor.execute("SELECT COUNT(*) FROM messages")
-        total_messages = cursor.fetchone()[0]
+            # Количество сессий и сообщений — из счётчиков, без COUNT(*)
+            cursor.execute("SELECT k, v FROM stats")
+            counters = dict(cursor.fetchall())
 
-        # Размер базы данных
-        db_size_mb = Path(self.db_path).stat().st_size / (1024 * 1024)
+            # Размер базы данных — по страницам, видимым соединению
+            # (учитывает и ещё не перенесённые из WAL), без stat() файлов
+            page_count = cursor.execute("PRAGMA page_count").fetchone()[0]
+            page_size = cursor.execute("PRAGMA page_size").fetchone()[0]
 
-        conn.close()
+        db_size_mb = page_count * page_size / (1024 * 1024)
 
         return {
-            "active_sessions": active_sessions,
-            "total_messages": total_messages,
+            "active_sessions": counters["sessions"],
+            "total_messages": counters["messages"],
             "db_size_mb": round(db_size_mb, 2),
         }
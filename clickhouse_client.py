@@ -2,7 +2,9 @@
 ClickHouse клиент с прямым подключением и экспортом в Parquet
 """
 import json
+import threading
 import time
+import uuid
 import hashlib
 import clickhouse_connect
 import pandas as pd
@@ -17,6 +19,12 @@ from config import (
     TEMP_DIR,
 )
 
+# Время жизни кэша схемы таблиц (секунды)
+SCHEMA_CACHE_TTL = 300
+
+# Форматы чтения для типов, которые pandas/Parquet не хранят как объекты Python
+DF_QUERY_FORMATS = {"UUID": "string", "IPv*": "string"}
+
 
 class ClickHouseClient:
     """Прямое подключение к ClickHouse"""
@@ -29,6 +37,9 @@ class ClickHouseClient:
             "password": CLICKHOUSE_PASSWORD,
             "database": CLICKHOUSE_DATABASE,
             "secure": True,
+            # Без сессии — один клиент (и его пул соединений) безопасно
+            # используется параллельными запросами агента из разных потоков
+            "autogenerate_session_id": False,
         }
         if CLICKHOUSE_SSL_CERT:
             connect_kwargs["verify"] = True
@@ -37,10 +48,23 @@ class ClickHouseClient:
             connect_kwargs["verify"] = False
 
         self.client = clickhouse_connect.get_client(**connect_kwargs)
+        # Кэш list_tables: (JSON-строка, время получения по monotonic)
+        self._tables_cache = None
+        # Созданные этим процессом parquet файлы: путь -> время создания
+        self._parquet_lock = threading.Lock()
+        self._parquet_files = {}
         print(f"✅ ClickHouse подключён: {CLICKHOUSE_HOST}:{CLICKHOUSE_PORT}/{CLICKHOUSE_DATABASE}")
 
     def list_tables(self) -> str:
-        """Получить список таблиц с колонками и типами. Возвращает JSON-строку."""
+        """
+        Получить список таблиц с колонками и типами. Возвращает JSON-строку.
+        Результат кэшируется на SCHEMA_CACHE_TTL секунд — схема меняется редко,
+        а list_tables вызывается в начале почти каждой сессии.
+        """
+        cached = self._tables_cache
+        if cached is not None and time.monotonic() - cached[1] < SCHEMA_CACHE_TTL:
+            return cached[0]
+
         result = self.client.query(
             "SELECT table, name, type "
             "FROM system.columns "
@@ -55,7 +79,9 @@ class ClickHouseClient:
             tables[table_name].append({"name": col_name, "type": col_type})
 
         output = [{"table": t, "columns": cols} for t, cols in tables.items()]
-        return json.dumps(output, ensure_ascii=False, indent=2)
+        tables_json = json.dumps(output, ensure_ascii=False, indent=2)
+        self._tables_cache = (tables_json, time.monotonic())
+        return tables_json
 
     def execute_query(self, sql: str) -> str:
         """
@@ -76,19 +102,25 @@ class ClickHouseClient:
             sql_stripped = f"{sql_stripped.rstrip().rstrip(';')} LIMIT 50000"
 
         try:
-            result = self.client.query(sql_stripped)
-
-            # Создать DataFrame
-            df = pd.DataFrame(result.result_rows, columns=result.column_names)
-
-            # Сохранить в Parquet
             query_hash = hashlib.md5(sql_stripped.encode()).hexdigest()[:10]
-            parquet_filename = f"query_{query_hash}_{int(time.time())}.parquet"
+            # uuid — одинаковый SQL в ту же секунду из разных сессий
+            # не должен писать в один и тот же файл
+            parquet_filename = f"query_{query_hash}_{int(time.time())}_{uuid.uuid4().hex}.parquet"
             parquet_path = str(TEMP_DIR / parquet_filename)
+
+            # Native формат — типизированный DataFrame (DateTime -> datetime64,
+            # Enum -> метки). Результат пишется в Parquet целиком: pyarrow
+            # выводит типы object-колонок (Decimal, Map) по всему столбцу,
+            # а при записи по блокам вывод по первому блоку не подходит к следующим
+            df = self.client.query_df(sql_stripped, query_formats=DF_QUERY_FORMATS)
             df.to_parquet(parquet_path, engine="pyarrow", index=False)
 
+            with self._parquet_lock:
+                self._parquet_files[parquet_path] = time.time()
+
             # Превью — первые 5 строк
-            preview = df.head(5).to_dict(orient="records")
+            preview_df = df.head(5)
+            preview = preview_df.to_dict(orient="records")
             # Конвертация сложных типов для JSON
             for row in preview:
                 for k, v in row.items():
@@ -104,8 +136,8 @@ class ClickHouseClient:
             return json.dumps({
                 "success": True,
                 "row_count": len(df),
-                "columns": list(df.columns),
-                "dtypes": {col: str(df[col].dtype) for col in df.columns},
+                "columns": list(preview_df.columns),
+                "dtypes": preview_df.dtypes.astype(str).to_dict(),
                 "preview_first_5_rows": preview,
                 "parquet_path": parquet_path,
             }, ensure_ascii=False, default=str)
@@ -116,3 +148,11 @@ class ClickHouseClient:
                 "error": str(e),
                 "sql": sql_stripped,
             })
+
+    def pop_expired_parquet(self, cutoff: float) -> list:
+        """Забрать из реестра пути parquet файлов, созданных раньше cutoff"""
+        with self._parquet_lock:
+            expired = [p for p, created in self._parquet_files.items() if created < cutoff]
+            for path in expired:
+                del self._parquet_files[path]
+        return expired
@@ -4,10 +4,15 @@
 """
 import json
 import logging
+import os
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 import anthropic
+import httpx
+import orjson
 from config import ANTHROPIC_API_KEY, MODEL, MAX_TOKENS, TEMP_DIR
 from clickhouse_client import ClickHouseClient
 from python_sandbox import PythonSandbox
@@ -16,6 +21,73 @@ from tools import TOOLS, SYSTEM_PROMPT
 
 logger = logging.getLogger(__name__)
 
+# Системный промпт с точкой кэширования: префикс tools + system
+# рендерится один раз и переиспользуется Anthropic между итерациями и запросами
+SYSTEM_BLOCKS = [
+    {
+        "type": "text",
+        "text": SYSTEM_PROMPT,
+        "cache_control": {"type": "ephemeral"},
+    }
+]
+
+
+# Сколько последних сообщений истории отправлять Claude дословно;
+# более ранние сворачиваются в одну короткую сводку
+HISTORY_VERBATIM = 8
+# Сколько символов каждого старого сообщения попадает в сводку
+SUMMARY_SNIPPET_CHARS = 300
+
+# Потоки для параллельного выполнения tool_use блоков одного хода
+TOOL_THREADS = 4
+
+# Интервал опроса статуса Message Batch (секунды)
+BATCH_POLL_INTERVAL = 30
+
+# Каждый какой запуск cleanup_temp_files обходит весь TEMP_DIR
+TEMP_FULL_SCAN_EVERY = 4
+
+
+@lru_cache(maxsize=1)
+def get_anthropic_client() -> anthropic.Anthropic:
+    """
+    Общий клиент Anthropic на процесс: пул keep-alive соединений
+    переживает запросы и экземпляры агента (без TLS-рукопожатия на каждый ход)
+    """
+    http_client = anthropic.DefaultHttpxClient(
+        limits=httpx.Limits(
+            max_connections=32,
+            max_keepalive_connections=16,
+            keepalive_expiry=60,
+        )
+    )
+    return anthropic.Anthropic(api_key=ANTHROPIC_API_KEY, http_client=http_client)
+
+
+def _dumps(obj) -> str:
+    """
+    JSON-строка через orjson (в разы быстрее stdlib json, UTF-8 как есть).
+    Строки с одиночными суррогатами orjson не принимает — для них stdlib json.
+    """
+    try:
+        return orjson.dumps(obj, default=str).decode('utf-8')
+    except orjson.JSONEncodeError:
+        return json.dumps(obj, ensure_ascii=False, default=str)
+
+
+def _safe_text(text: str) -> str:
+    """
+    Убрать из строки то, что не кодируется в UTF-8 (одиночные суррогаты).
+    Обычная строка возвращается как есть, без перекодирования.
+    """
+    if text.isascii():
+        return text
+    try:
+        text.encode('utf-8')
+        return text
+    except UnicodeEncodeError:
+        return text.encode('utf-8', errors='ignore').decode('utf-8')
+
 
 class CompositeAnalysisAgent:
     """
@@ -26,10 +98,12 @@ class CompositeAnalysisAgent:
     """
 
     def __init__(self):
-        self.anthropic_client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+        self.anthropic_client = get_anthropic_client()
         self.ch_client = ClickHouseClient()
         self.sandbox = PythonSandbox()
         self.chat_storage = ChatStorage()
+        self._tool_pool = ThreadPoolExecutor(max_workers=TOOL_THREADS, thread_name_prefix="tool")
+        self._cleanup_runs = 0
 
     def analyze(self, user_query: str, session_id: str) -> dict:
         """
@@ -39,20 +113,92 @@ class CompositeAnalysisAgent:
         start_total = time.time()
         logger.info("📥 Начало анализа: session_id=%s query=%.80r", session_id, user_query)
 
+        messages = self._prepare_messages(user_query, session_id)
+        return self._agent_loop(messages, session_id, start_total)
+
+    def analyze_batch(self, queries: list[tuple[str, str]]) -> dict:
+        """
+        Пакетный анализ для неинтерактивных задач (отчёты, регрессионные прогоны).
+        queries — список (session_id, запрос), session_id должны быть уникальны.
+        Первый вызов Claude для всех запросов идёт одним Message Batch
+        (дешевле, но ответ может ждать до 24 часов), дальше каждый запрос
+        продолжает обычный агентный цикл с tools.
+        Возвращает dict session_id -> результат как у analyze().
+        """
+        session_ids = [session_id for session_id, _ in queries]
+        if len(set(session_ids)) != len(session_ids):
+            raise ValueError("session_id в пакете должны быть уникальны")
+
+        prepared = {
+            session_id: self._prepare_messages(user_query, session_id)
+            for session_id, user_query in queries
+        }
+        batch = self.anthropic_client.messages.batches.create(
+            requests=[
+                {"custom_id": session_id, "params": self._request_params(messages)}
+                for session_id, messages in prepared.items()
+            ]
+        )
+        logger.info("📦 Пакет %s отправлен: запросов=%d", batch.id, len(prepared))
+
+        while batch.processing_status != "ended":
+            time.sleep(BATCH_POLL_INTERVAL)
+            batch = self.anthropic_client.messages.batches.retrieve(batch.id)
+
+        results = {}
+        for entry in self.anthropic_client.messages.batches.results(batch.id):
+            session_id = entry.custom_id
+            if entry.result.type == "succeeded":
+                results[session_id] = self._agent_loop(
+                    prepared[session_id], session_id, time.time(),
+                    first_response=entry.result.message,
+                )
+            else:
+                logger.error("❌ Пакет %s: session_id=%s result=%s", batch.id, session_id, entry.result.type)
+                results[session_id] = {
+                    "success": False,
+                    "text_output": "",
+                    "plots": [],
+                    "tool_calls": [],
+                    "error": f"Ошибка пакетного запроса: {entry.result.type}",
+                    "session_id": session_id,
+                }
+        return results
+
+    def _prepare_messages(self, user_query: str, session_id: str) -> list:
+        """Сохранить запрос пользователя и собрать messages для Claude"""
         # 0. Sanitize input (предотвращает UTF-8 ошибки)
-        user_query = user_query.encode('utf-8', errors='ignore').decode('utf-8', errors='ignore')
+        user_query = _safe_text(user_query)
 
         # 1. Сохранить сообщение пользователя в историю
         self.chat_storage.save_user_message(session_id, user_query)
 
-        # 2. Получить историю из SQLite
-        history = self.chat_storage.get_history(session_id)
+        # 2-3. История из SQLite (через кэш) — уже в формате messages для
+        # Anthropic API; список свой, в него дописываются ходы с tools
+        return self._compact_history(self.chat_storage.get_history(session_id))
+
+    @staticmethod
+    def _request_params(messages: list) -> dict:
+        """Параметры запроса к Messages API (общие для обычного и пакетного)"""
+        return {
+            "model": MODEL,
+            "max_tokens": MAX_TOKENS,
+            "system": SYSTEM_BLOCKS,
+            "tools": TOOLS,
+            "messages": messages,
+        }
 
-        # 3. Подготовить messages для Anthropic API
-        messages = []
-        for msg in history:
-            messages.append({"role": msg["role"], "content": msg["content"]})
+    def _call_claude(self, messages: list):
+        """
+        Вызов Claude через стриминг: ответ приходит по мере генерации,
+        соединение не простаивает до последнего токена и не упирается
+        в таймаут чтения на длинных ответах
+        """
+        with self.anthropic_client.messages.stream(**self._request_params(messages)) as stream:
+            return stream.get_final_message()
 
+    def _agent_loop(self, messages: list, session_id: str, start_total: float, first_response=None) -> dict:
+        """Агентный цикл: вызовы Claude и tools до финального ответа"""
         # 4. Переменные для сбора результатов
         all_plots = []        # Все графики со всех вызовов python_analysis
         tool_calls_log = []   # Лог вызовов для отладки
@@ -62,15 +208,12 @@ class CompositeAnalysisAgent:
         for iteration in range(max_iterations):
             logger.info("🔄 Итерация %d: вызов Claude API (session_id=%s)", iteration + 1, session_id)
 
-            # 5a. Вызов Claude
+            # 5a. Вызов Claude (первый ответ мог прийти из Message Batches API)
             try:
-                response = self.anthropic_client.messages.create(
-                    model=MODEL,
-                    max_tokens=MAX_TOKENS,
-                    system=SYSTEM_PROMPT,
-                    tools=TOOLS,
-                    messages=messages,
-                )
+                if iteration == 0 and first_response is not None:
+                    response = first_response
+                else:
+                    response = self._call_claude(messages)
             except Exception as e:
                 logger.error(
                     "❌ Ошибка Claude API на итерации %d (session_id=%s): %s\n%s",
@@ -137,41 +280,45 @@ class CompositeAnalysisAgent:
 
                 # Выполнить каждый tool_use и собрать результаты
                 tool_results_content = []
-
-                for block in response.content:
-                    if block.type == "tool_use":
-                        # Выполнить tool
-                        tool_result = self._execute_tool(block.name, block.input)
-
-                        # Sanitize tool result (из рабочего CLI агента)
-                        tool_result = tool_result.encode('utf-8', errors='ignore').decode('utf-8', errors='ignore')
-
-                        # Если python_analysis — достать графики
-                        if block.name == "python_analysis":
-                            try:
-                                result_data = json.loads(tool_result)
-                                if result_data.get("plots"):
-                                    all_plots.extend(result_data["plots"])
-                                    # Убрать plots из tool_result чтобы не раздувать контекст Claude
-                                    result_data_for_claude = {k: v for k, v in result_data.items() if k != "plots"}
-                                    result_data_for_claude["plots_count"] = len(result_data["plots"])
-                                    tool_result = json.dumps(result_data_for_claude, ensure_ascii=False, default=str)
-                            except:
-                                pass
-
-                        # Логировать
-                        tool_calls_log.append({
-                            "tool": block.name,
-                            "input": block.input,
-                            "iteration": iteration,
-                        })
-
-                        # Добавить результат для Claude
-                        tool_results_content.append({
-                            "type": "tool_result",
-                            "tool_use_id": block.id,
-                            "content": tool_result,
-                        })
+                tool_blocks = [block for block in response.content if block.type == "tool_use"]
+
+                # Несколько запросов к ClickHouse за ход — параллельно (ждут сеть).
+                # python_analysis выполняется здесь же по порядку: pyplot хранит
+                # фигуры в глобальном состоянии и не потокобезопасен
+                futures = {}
+                if len(tool_blocks) > 1:
+                    futures = {
+                        block.id: self._tool_pool.submit(self._execute_tool, block.name, block.input)
+                        for block in tool_blocks
+                        if block.name != "python_analysis"
+                    }
+
+                for block in tool_blocks:
+                    # Выполнить tool (или забрать результат из пула)
+                    if block.id in futures:
+                        tool_result, plots = futures[block.id].result()
+                    else:
+                        tool_result, plots = self._execute_tool(block.name, block.input)
+
+                    # Графики python_analysis — в ответ пользователю (Claude их не получает)
+                    all_plots.extend(plots)
+
+                    # Sanitize tool result (из рабочего CLI агента)
+                    tool_result = _safe_text(tool_result)
+
+                    # Логировать
+                    tool_calls_log.append({
+                        "tool": block.name,
+                        "input": block.input,
+                        "iteration": iteration,
+                    })
+
+                    # Добавить результат для Claude
+                    tool_results_content.append({
+                        "type": "tool_result",
+                        "tool_use_id": block.id,
+                        "content": tool_result,
+                    })
 
                 # Добавить результаты tools в messages
                 messages.append({"role": "user", "content": tool_results_content})
@@ -207,8 +354,37 @@ class CompositeAnalysisAgent:
             "session_id": session_id,
         }
 
-    def _execute_tool(self, tool_name: str, tool_input: dict) -> str:
-        """Выполнить tool и вернуть результат как JSON-строку"""
+    @staticmethod
+    def _compact_history(history: list) -> list:
+        """
+        Свернуть старые сообщения истории в одну сводку.
+        Последние HISTORY_VERBATIM сообщений остаются как есть,
+        от более ранних — только начало текста (без вызова Claude).
+        """
+        if len(history) <= HISTORY_VERBATIM:
+            return history
+
+        old, recent = history[:-HISTORY_VERBATIM], history[-HISTORY_VERBATIM:]
+        lines = []
+        for msg in old:
+            speaker = "Пользователь" if msg["role"] == "user" else "Ассистент"
+            text = " ".join(msg["content"][:SUMMARY_SNIPPET_CHARS].split())
+            if len(msg["content"]) > SUMMARY_SNIPPET_CHARS:
+                text += "…"
+            lines.append(f"{speaker}: {text}")
+
+        summary = {
+            "role": "user",
+            "content": "[Краткое содержание предыдущего диалога]\n" + "\n".join(lines),
+        }
+        return [summary] + recent
+
+    def _execute_tool(self, tool_name: str, tool_input: dict) -> tuple[str, list]:
+        """
+        Выполнить tool и вернуть (результат как JSON-строку, графики base64).
+        Графики отделяются до сериализации, чтобы не раздувать контекст Claude.
+        """
+        plots = []
         # Краткое представление входных параметров для лога
         input_summary = str(tool_input)[:120]
         logger.info("🔧 Tool start: %s | input=%s", tool_name, input_summary)
@@ -227,15 +403,19 @@ class CompositeAnalysisAgent:
                     code=tool_input["code"],
                     parquet_path=tool_input["parquet_path"],
                 )
+                # Убрать plots из результата чтобы не раздувать контекст Claude
+                if raw.get("plots"):
+                    plots = raw.pop("plots")
+                    raw["plots_count"] = len(plots)
                 # sandbox.execute() возвращает dict, сериализуем в JSON
-                result = json.dumps(raw, ensure_ascii=False, default=str)
+                result = _dumps(raw)
 
             else:
-                result = json.dumps({"error": f"Unknown tool: {tool_name}"})
+                result = _dumps({"error": f"Unknown tool: {tool_name}"})
 
             elapsed = round(time.time() - t_start, 1)
             logger.info("✅ Tool done: %s | time=%.1fs", tool_name, elapsed)
-            return result
+            return result, plots
 
         except Exception as e:
             elapsed = round(time.time() - t_start, 1)
@@ -243,17 +423,41 @@ class CompositeAnalysisAgent:
                 "❌ Tool error: %s | time=%.1fs | error=%s\n%s",
                 tool_name, elapsed, e, traceback.format_exc(),
             )
-            return json.dumps({
+            return _dumps({
                 "error": str(e),
                 "traceback": traceback.format_exc()
-            })
+            }), []
+
+    def cleanup_temp_files(self, scan_dir: bool = True):
+        """
+        Удалить временные parquet файлы старше 1 часа.
+        scan_dir=False — только файлы этого процесса, без обхода TEMP_DIR.
+        """
+        cutoff = time.time() - 3600
 
-    def cleanup_temp_files(self):
-        """Удалить временные parquet файлы старше 1 часа"""
-        import time
-        for f in TEMP_DIR.glob("*.parquet"):
-            if f.stat().st_mtime < time.time() - 3600:
+        # Обычно — только файлы из реестра ClickHouse клиента, без обхода каталога
+        for path in self.ch_client.pop_expired_parquet(cutoff):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+        if not scan_dir:
+            return
+
+        # Полный обход — при первом запуске и каждый TEMP_FULL_SCAN_EVERY-й:
+        # подбирает файлы других воркеров и оставшиеся от прошлых запусков
+        run = self._cleanup_runs
+        self._cleanup_runs += 1
+        if run % TEMP_FULL_SCAN_EVERY:
+            return
+
+        with os.scandir(TEMP_DIR) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".parquet"):
+                    continue
                 try:
-                    f.unlink()
-                except:
+                    if entry.is_file() and entry.stat().st_mtime < cutoff:
+                        os.unlink(entry.path)
+                except OSError:
                     pass
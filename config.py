@@ -33,3 +33,9 @@ TEMP_DIR = Path("./temp_data")
 TEMP_DIR.mkdir(exist_ok=True)
 
 SERVER_URL = os.environ.get("SERVER_URL", "http://localhost:8000")
+
+# Количество воркеров uvicorn (процессов)
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "1"))
+
+# Максимум одновременных анализов в одном воркере
+MAX_CONCURRENT_ANALYSES = int(os.environ.get("MAX_CONCURRENT_ANALYSES", "2"))
@@ -30,7 +30,8 @@ class PythonSandbox:
         """
         try:
             # ШАГ 1: Загрузить данные из Parquet в DataFrame
-            df = pd.read_parquet(parquet_path)
+            # memory_map — страницы файла берутся из page cache без лишнего чтения в буфер
+            df = pd.read_parquet(parquet_path, engine="pyarrow", memory_map=True)
         except Exception as e:
             return {
                 "success": False,
@@ -65,9 +66,14 @@ class PythonSandbox:
                 for fig_num in plt.get_fignums():
                     fig = plt.figure(fig_num)
                     buf = io.BytesIO()
-                    fig.savefig(buf, format='png', bbox_inches='tight', dpi=150)
-                    buf.seek(0)
-                    b64 = base64.b64encode(buf.read()).decode('utf-8')
+                    # dpi=100 достаточно для веб-интерфейса; compress_level=1 —
+                    # быстрое сжатие zlib ценой чуть большего размера PNG
+                    fig.savefig(
+                        buf, format='png', bbox_inches='tight', dpi=100,
+                        pil_kwargs={'compress_level': 1},
+                    )
+                    # getbuffer() — без промежуточной копии bytes
+                    b64 = base64.b64encode(buf.getbuffer()).decode('ascii')
                     plots.append(f"data:image/png;base64,{b64}")
                     buf.close()
 
@@ -97,7 +103,9 @@ class PythonSandbox:
             }
 
         finally:
-            # ОБЯЗАТЕЛЬНО очистить matplotlib и переменные
-            plt.close('all')
-            plt.clf()
+            # ОБЯЗАТЕЛЬНО очистить matplotlib и переменные.
+            # plt.clf() после close('all') не нужен: он лишь создавал новую
+            # пустую фигуру, которая попадала в захват графиков следующего вызова
+            if plt.get_fignums():
+                plt.close('all')
             local_vars.clear()
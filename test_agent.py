@@ -217,8 +217,60 @@ def generate_plots_html(plots: list, query: str) -> str:
     return html
 
 
+def check_datetime_roundtrip():
+    """
+    Проверка типов выгрузки: DateTime из ClickHouse должен доехать до
+    DataFrame в python_analysis как datetime64, Enum — как метки,
+    Decimal и Map — без потерь, даже если результат пришёл несколькими блоками
+    """
+    import json
+    from decimal import Decimal
+    import pandas as pd
+    from clickhouse_client import ClickHouseClient
+
+    print_separator("Проверка типов ClickHouse -> Parquet")
+    client = ClickHouseClient()
+
+    def load(sql):
+        result = json.loads(client.execute_query(sql))
+        if not result["success"]:
+            print(f"❌ Ошибка запроса: {result['error']}")
+            sys.exit(1)
+        print(f"   dtypes: {result['dtypes']}")
+        return pd.read_parquet(result["parquet_path"])
+
+    df = load(
+        "SELECT toDateTime('2024-01-01 00:00:00') + number * 3600 AS ts, "
+        "CAST(if(number % 2, 'b', 'a') AS Enum8('a' = 1, 'b' = 2)) AS e "
+        "FROM numbers(10)"
+    )
+    # 150000 строк — больше одного блока (max_block_size по умолчанию 65409);
+    # значения во втором блоке не похожи на значения первого
+    blocks_df = load(
+        "SELECT toDecimal64(if(number < 70000, '1.50', '12345.67'), 2) AS amount, "
+        "map(if(number < 70000, 'k1', 'k2'), number) AS m "
+        "FROM numbers(150000) LIMIT 150000"
+    )
+    checks = {
+        "DateTime -> datetime64": pd.api.types.is_datetime64_any_dtype(df["ts"]),
+        "Enum -> метки": set(df["e"]) == {"a", "b"},
+        "Decimal в нескольких блоках": (
+            len(blocks_df) == 150000
+            and set(blocks_df["amount"]) == {Decimal("1.50"), Decimal("12345.67")}
+        ),
+        "Map в нескольких блоках": "k2" in str(blocks_df["m"].iloc[-1]),
+    }
+    for name, ok in checks.items():
+        print(f"{'✅' if ok else '❌'} {name}")
+    if not all(checks.values()):
+        sys.exit(1)
+
+
 def main():
     """Главная функция"""
+    if "--check-types" in sys.argv:
+        check_datetime_roundtrip()
+        return
     test_agent()
 
 